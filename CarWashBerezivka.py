@@ -1,15 +1,41 @@
 import asyncio
 import asyncpg
+import heapq
 import os
+import phonenumbers
 import re
-from aiogram import Bot, Dispatcher, Router, types
-from aiogram.filters import Command
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation
+from aiogram.fsm.storage.memory import MemoryStorage, MemoryStorageRecord
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from datetime import datetime, timedelta
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from datetime import date, datetime, time as dt_time, timedelta
 from dotenv import load_dotenv
 
+try:
+    import uvloop  # швидший event loop; на Windows недоступний
+except ImportError:
+    uvloop = None
+
 API_TOKEN = os.getenv("API_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+# З WEBHOOK_URL (публічна https-адреса бота) Telegram сам надсилає оновлення на WEBHOOK_PATH;
+# без нього бот, як і раніше, працює через polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PORT = int(os.getenv("PORT", 8080))
 BUFFER_MINUTES = 1
 
 
@@ -17,21 +43,116 @@ if not API_TOKEN:
     raise RuntimeError("API_TOKEN відсутній у .env")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL відсутній у .env")
+# без секрету будь-хто може надіслати на WEBHOOK_PATH підроблене оновлення від імені адміна
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET відсутній у .env (обов'язковий разом із WEBHOOK_URL)")
 
 print("API_TOKEN:", "***" if API_TOKEN else None)
 print("DATABASE_URL:", "***" if DATABASE_URL else None)
 
 # --- Aiogram ---
+# Незавершене бронювання живе не довше FSM_TTL секунд від останнього кроку — покинуті
+# чернетки (/book без завершення) не накопичуються вічно
+FSM_TTL = int(os.getenv("FSM_TTL", 1800))
+FSM_MEMORY_MAXSIZE = int(os.getenv("FSM_MEMORY_MAXSIZE", 10000))
+
+
+class TTLMemoryStorage(MemoryStorage):
+    """MemoryStorage з обмеженим TTL-кешем замість необмеженого defaultdict."""
+
+    def __init__(self, maxsize: int, ttl: int) -> None:
+        self.storage = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _record(self, key) -> MemoryStorageRecord:
+        record = self.storage.get(key) or MemoryStorageRecord()
+        self.storage[key] = record  # повторний запис оновлює TTL
+        return record
+
+    async def set_state(self, key, state=None) -> None:
+        self._record(key).state = state.state if isinstance(state, State) else state
+
+    async def get_state(self, key):
+        record = self.storage.get(key)
+        return record.state if record else None
+
+    async def set_data(self, key, data) -> None:
+        self._record(key).data = data.copy()
+
+    async def get_data(self, key):
+        record = self.storage.get(key)
+        return record.data.copy() if record else {}
+
+
+class UserEventIsolation(BaseEventIsolation):
+    """Оновлення одного користувача обробляються по черзі, різних користувачів — паралельно.
+
+    Те саме, що SimpleEventIsolation, але лок видаляється, щойно його ніхто не чекає.
+    """
+
+    def __init__(self) -> None:
+        self._locks: dict = {}  # ключ -> [Lock, скільки обробників його тримають/чекають]
+
+    @asynccontextmanager
+    async def lock(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def close(self) -> None:
+        self._locks.clear()
+
+
+# Стан незавершених бронювань зберігається у FSM-сховищі: з REDIS_URL — у Redis (спільний
+# для кількох процесів бота і переживає рестарт), інакше — у пам'яті процесу
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    events_isolation = storage.create_isolation()
+else:
+    storage = TTLMemoryStorage(maxsize=FSM_MEMORY_MAXSIZE, ttl=FSM_TTL)
+    events_isolation = UserEventIsolation()
+
 bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+# Кожне оновлення обробляється окремою задачею (handle_as_tasks у start_polling), а
+# events_isolation тримає порядок кроків бронювання в межах одного користувача
+dp = Dispatcher(storage=storage, events_isolation=events_isolation)
 router = Router()
 
 # --- Константи ---
 MAIN_ADMIN_ID = 863294823
-user_booking: dict[int, dict] = {}
-
-# --- Пул з'єднань PostgreSQL ---
+CAR_NUMBER_RE = re.compile(r"^[A-ZА-ЯІЇЄ]{2}\d{4}[A-ZА-ЯІЇЄ]{2}$")
+
+
+class BookingForm(StatesGroup):
+    # кроки бронювання — кожен крок обробляє окремий хендлер
+    program = State()
+    date = State()
+    time = State()
+    car = State()
+    phone = State()
+
+# --- Пули з'єднань PostgreSQL ---
+# pool — основний (запис), pool_ro — лише читання: репліка з DATABASE_URL_REPLICA, а без неї —
+# окремий пул до тієї ж БД, щоб сплеск записів не забирав з'єднання у читаючих команд
+DATABASE_URL_REPLICA = os.getenv("DATABASE_URL_REPLICA")
+# Розміри й таймаути пулів налаштовуються змінними оточення під конкретний інстанс
+# (сума max_size обох пулів не має перевищувати ліміт з'єднань Postgres/pgbouncer)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 10))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 50))
+DB_POOL_RO_MIN_SIZE = int(os.getenv("DB_POOL_RO_MIN_SIZE", 5))
+DB_POOL_RO_MAX_SIZE = int(os.getenv("DB_POOL_RO_MAX_SIZE", 20))
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", 50000))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 60))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 2048))
 pool: asyncpg.Pool | None = None
+pool_ro: asyncpg.Pool | None = None
 
 # ---------- ІНІЦІАЛІЗАЦІЯ БД ----------
 CREATE_TABLES_SQL = """
@@ -69,6 +190,29 @@ CREATE TABLE IF NOT EXISTS bookings (
     actual_end TIMESTAMP
 );
 
+CREATE TABLE IF NOT EXISTS pending_notifications (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    notify_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    text TEXT NOT NULL
+);
+
+-- Індекси для частих фільтрів по бронюваннях
+-- (фільтри по даті пишемо як діапазон booking_datetime, щоб працював idx_bookings_datetime)
+CREATE INDEX IF NOT EXISTS idx_bookings_datetime ON bookings (booking_datetime);
+CREATE INDEX IF NOT EXISTS idx_bookings_user_active ON bookings (user_id, booking_datetime)
+    WHERE status IN ('scheduled', 'in_progress');
+
+-- Пошук по номеру авто (ILIKE '%...%') — trigram-індекс, якщо розширення pg_trgm доступне
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS idx_bookings_car_number_trgm ON bookings USING gin (car_number gin_trgm_ops);
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm недоступне, пошук по номеру авто без індексу: %', SQLERRM;
+END
+$$;
+
 -- Міграції для старих БД (дружні до повторного запуску)
 ALTER TABLE programs
     ADD COLUMN IF NOT EXISTS price NUMERIC(12,2) DEFAULT 0;
@@ -82,17 +226,83 @@ async def init_db():
         await conn.execute(CREATE_TABLES_SQL)
 
 # ---------- ХЕЛПЕРИ ДЛЯ БД ----------
+# З'єднання, захоплене обробником через acquire_conn(); хелпери нижче використовують його,
+# щоб кілька послідовних запитів не брали/повертали з'єднання з пулу щоразу
+_current_conn: ContextVar[asyncpg.Connection | None] = ContextVar("_current_conn", default=None)
+_current_conn_readonly: ContextVar[bool] = ContextVar("_current_conn_readonly", default=False)
+
+@asynccontextmanager
+async def acquire_conn(readonly: bool = False):
+    conn = _current_conn.get()
+    if conn is not None and (readonly or not _current_conn_readonly.get()):
+        # вкладений виклик — працюємо на вже захопленому з'єднанні
+        yield conn
+        return
+    async with (pool_ro if readonly else pool).acquire() as conn:
+        token = _current_conn.set(conn)
+        ro_token = _current_conn_readonly.set(readonly)
+        try:
+            yield conn
+        finally:
+            _current_conn_readonly.reset(ro_token)
+            _current_conn.reset(token)
+
 async def db_fetch(query: str, *args):
-    async with pool.acquire() as conn:
+    conn = _current_conn.get()
+    if conn is not None:
         return await conn.fetch(query, *args)
+    return await pool.fetch(query, *args)
 
 async def db_fetchrow(query: str, *args):
-    async with pool.acquire() as conn:
+    conn = _current_conn.get()
+    if conn is not None:
         return await conn.fetchrow(query, *args)
+    return await pool.fetchrow(query, *args)
 
 async def db_execute(query: str, *args):
-    async with pool.acquire() as conn:
+    conn = _current_conn.get()
+    if conn is not None:
         return await conn.execute(query, *args)
+    return await pool.execute(query, *args)
+
+# Найчастіші запити. asyncpg готує (PREPARE) кожен запит один раз на з'єднання і кешує його
+# за текстом, тож тримаємо текст в одному місці, щоб усі виклики потрапляли в один запис кешу.
+IS_ADMIN_SQL = "SELECT 1 FROM admins WHERE user_id=$1"
+BOOKING_STATUS_SQL = "SELECT status FROM bookings WHERE id=$1"
+BOOKINGS_INSERT_SQL = """
+    INSERT INTO bookings (user_id, username, phone_number, program_id, car_number, booking_datetime)
+    VALUES ($1, $2, $3, $4, $5, $6)
+"""
+# Вільні слоти дня: $1 тривалість (хв), $2/$3 початок/кінець робочого дня,
+# $4 найраніший дозволений старт, $5 початок доби, $6 буфер між мийками
+AVAILABLE_HOURS_SQL = """
+    SELECT to_char(gs, 'HH24:MI') AS slot
+    FROM generate_series($2::timestamp, $3::timestamp - interval '1 hour', interval '1 hour') AS gs
+    WHERE gs >= $4::timestamp
+      AND gs + $1::integer * interval '1 minute' <= $3::timestamp
+      AND NOT EXISTS (
+          SELECT 1
+          FROM bookings b
+          LEFT JOIN programs bp ON bp.id = b.program_id
+          CROSS JOIN LATERAL (
+              SELECT CASE WHEN b.status IN ('in_progress', 'finished')
+                          THEN COALESCE(b.actual_start, b.booking_datetime)
+                          ELSE b.booking_datetime
+                     END AS b_start
+          ) s
+          CROSS JOIN LATERAL (
+              SELECT CASE WHEN b.status IN ('in_progress', 'finished')
+                          THEN COALESCE(b.actual_end, s.b_start + COALESCE(bp.duration, 0) * interval '1 minute')
+                          ELSE s.b_start + COALESCE(bp.duration, 0) * interval '1 minute'
+                     END AS b_end
+          ) e
+          WHERE b.booking_datetime >= $5::timestamp
+            AND b.booking_datetime < $5::timestamp + interval '1 day'
+            AND gs < e.b_end + $6::interval
+            AND gs + $1::integer * interval '1 minute' > s.b_start - $6::interval
+      )
+    ORDER BY gs
+"""
 
 async def save_user(user: types.User, phone_number: str | None = None):
     await db_execute(
@@ -111,28 +321,77 @@ async def save_user(user: types.User, phone_number: str | None = None):
         user.first_name,
         user.last_name
     )
-# ---------- ДОПОМІЖНЕ ----------
-async def get_programs():
+# ---------- КЕШ ПРОГРАМ ----------
+# Програми змінюються рідко, тому тримаємо їх у пам'яті: {id: (id, name, duration, price, description)}.
+# Кеш скидається після add_program/edit_program, а інші процеси бота дізнаються про зміни
+# через LISTEN/NOTIFY на каналі programs_changed (див. main()). PROGRAMS_CACHE_TTL — страховка
+# на випадок, якщо NOTIFY загубився (наприклад, обірвалось LISTEN-з'єднання).
+PROGRAMS_CACHE_TTL = 60
+_programs_cache: dict[int, tuple] | None = None
+_programs_cached_at = 0.0
+_programs_version = 0
+
+def invalidate_programs_cache(*_):
+    global _programs_cache, _programs_version
+    _programs_version += 1
+    _programs_cache = None
+
+async def notify_programs_changed():
+    invalidate_programs_cache()
+    await db_execute("NOTIFY programs_changed")
+
+async def get_programs_map() -> dict[int, tuple]:
+    global _programs_cache, _programs_cached_at
+    if _programs_cache is not None and time.monotonic() - _programs_cached_at < PROGRAMS_CACHE_TTL:
+        return _programs_cache
+
+    version = _programs_version
     rows = await db_fetch(
         "SELECT id, name, duration, price, description FROM programs ORDER BY id"
     )
     # перетворимо у звичайні tuples
-    return [(r["id"], r["name"], r["duration"], float(r["price"] or 0), r["description"] or "") for r in rows]
+    programs = {
+        r["id"]: (r["id"], r["name"], r["duration"], r["price"] or 0.0, r["description"] or "")
+        for r in rows
+    }
+    # якщо поки ми читали кеш встигли скинути — не зберігаємо застарілі дані
+    if version == _programs_version:
+        _programs_cache = programs
+        _programs_cached_at = time.monotonic()
+    return programs
+
+# ---------- ДОПОМІЖНЕ ----------
+# Формати дат/часу фіксовані, тож розбираємо їх регуляркою замість повільного strptime.
+# Як і strptime, обидві функції кидають ValueError на невірний рядок і приймають лише
+# ASCII-цифри ([0-9], а не \d, який ловить і арабські/інші Unicode-цифри).
+_DMY_RE = re.compile(r"([0-9]{1,2})\.([0-9]{1,2})\.([0-9]{4})")
+_HM_RE = re.compile(r"([0-9]{1,2}):([0-9]{1,2})")
+
+def parse_dmy(text: str) -> date:
+    """dd.mm.yyyy -> date"""
+    m = _DMY_RE.fullmatch(text)
+    if not m:
+        raise ValueError(f"невірна дата: {text!r}")
+    return date(int(m[3]), int(m[2]), int(m[1]))
+
+def parse_hm(text: str) -> dt_time:
+    """HH:MM -> time"""
+    m = _HM_RE.fullmatch(text)
+    if not m:
+        raise ValueError(f"невірний час: {text!r}")
+    return dt_time(int(m[1]), int(m[2]))
+
+async def get_programs():
+    return list((await get_programs_map()).values())
 
 async def is_admin(user_id: int) -> bool:
     if user_id == MAIN_ADMIN_ID:
         return True
-    row = await db_fetchrow("SELECT 1 FROM admins WHERE user_id=$1", user_id)
+    row = await db_fetchrow(IS_ADMIN_SQL, user_id)
     return bool(row)
 
 
-async def notify_next_after_buffer(finished_booking_id: int):
-    finished_booking = await db_fetchrow(
-        "SELECT booking_datetime FROM bookings WHERE id=$1", finished_booking_id
-    )
-    if not finished_booking:
-        return
-
+async def notify_next_after_buffer(finished_booking_datetime: datetime):
     next_booking = await db_fetchrow(
         """
         SELECT b.id, b.user_id, b.car_number, b.booking_datetime
@@ -141,29 +400,66 @@ async def notify_next_after_buffer(finished_booking_id: int):
         ORDER BY b.booking_datetime ASC, b.id ASC
         LIMIT 1
         """,
-        finished_booking["booking_datetime"]
+        finished_booking_datetime
     )
 
     if not next_booking:
         return
 
     # ✅ Перевіряємо, що це той самий день
-    if next_booking["booking_datetime"].date() != finished_booking["booking_datetime"].date():
+    if next_booking["booking_datetime"].date() != finished_booking_datetime.date():
         return
 
-    notify_time = finished_booking["booking_datetime"] + timedelta(minutes=BUFFER_MINUTES)
-    now = datetime.now()
-    delay_seconds = max((notify_time - now).total_seconds(), 0)
-
-    async def delayed_notify():
-        await asyncio.sleep(delay_seconds)
-        await send_notify(
-            next_booking["user_id"],
-            f"🚗 Ваша мийка (ID {next_booking['id']}, авто {next_booking['car_number']}) "
-            f"може розпочатися раніше. Будь ласка, приїжджайте за можливості."
-        )
+    notify_time = finished_booking_datetime + timedelta(minutes=BUFFER_MINUTES)
+    await schedule_notify(
+        next_booking["user_id"],
+        f"🚗 Ваша мийка (ID {next_booking['id']}, авто {next_booking['car_number']}) "
+        f"може розпочатися раніше. Будь ласка, приїжджайте за можливості.",
+        notify_time,
+    )
 
-    asyncio.create_task(delayed_notify())
+
+# ---------- ОБМЕЖЕННЯ ШВИДКОСТІ ВІДПРАВКИ ----------
+# Telegram дозволяє ~30 повідомлень/с на бота і ~1/с в один чат; якщо перевищити — 429 і
+# очікування retry_after, яке відчують усі наступні користувачі. Тому чекаємо слот заздалегідь.
+SEND_RATE_PER_SECOND = 29
+CHAT_SEND_INTERVAL = 1.0
+TELEGRAM_MESSAGE_LIMIT = 4096
+_send_limiter = AsyncLimiter(SEND_RATE_PER_SECOND, 1.0)
+_chat_next_send: dict[int, float] = {}  # chat_id -> monotonic-час наступного дозволеного надсилання
+
+async def wait_send_slot(chat_id: int):
+    now = time.monotonic()
+    slot = max(now, _chat_next_send.get(chat_id, 0.0))
+    _chat_next_send[chat_id] = slot + CHAT_SEND_INTERVAL
+    if len(_chat_next_send) > 10000:
+        # прибираємо чати, для яких обмеження вже не діє
+        for cid in [cid for cid, t in _chat_next_send.items() if t <= now]:
+            del _chat_next_send[cid]
+    if slot > now:
+        await asyncio.sleep(slot - now)
+    await _send_limiter.acquire()
+
+class SendRateLimitMiddleware(BaseRequestMiddleware):
+    """Пропускає всі send*-запити бота (зокрема message.answer) через wait_send_slot."""
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None and method.__api_method__.startswith("send"):
+            await wait_send_slot(chat_id)
+        return await make_request(bot, method)
+
+bot.session.middleware(SendRateLimitMiddleware())
+
+def join_messages(texts: list[str], sep: str = "\n\n") -> list[str]:
+    """Склеює тексти в якомога менше повідомлень, не довших за TELEGRAM_MESSAGE_LIMIT."""
+    messages = []
+    for text in texts:
+        if messages and len(messages[-1]) + len(sep) + len(text) <= TELEGRAM_MESSAGE_LIMIT:
+            messages[-1] += sep + text
+        else:
+            messages.append(text)
+    return messages
 
 
 async def send_notify(user_id: int, text: str):
@@ -173,84 +469,139 @@ async def send_notify(user_id: int, text: str):
             print(f"Помилка надсилання повідомлення користувачу {user_id}: {e}")
 
 
+# ---------- ВІДКЛАДЕНІ ПОВІДОМЛЕННЯ ----------
+# Один фоновий цикл (notify_loop) замість окремої задачі зі sleep на кожне повідомлення.
+# Черга — heap (notify_at, id, user_id, text); кожен запис дублюється в pending_notifications,
+# тож після рестарту бота невідправлені повідомлення підхоплюються знову.
+_notify_queue: list[tuple[datetime, int, int, str]] = []
+_notify_wakeup = asyncio.Event()
+NOTIFY_RETRY_DELAY = 5  # секунд між спробами, якщо БД недоступна
+
+async def schedule_notify(user_id: int, text: str, notify_at: datetime):
+    row = await db_fetchrow(
+        "INSERT INTO pending_notifications (user_id, notify_at, text) VALUES ($1, $2, $3) RETURNING id",
+        user_id, notify_at, text
+    )
+    heapq.heappush(_notify_queue, (notify_at, row["id"], user_id, text))
+    _notify_wakeup.set()
+
+async def load_pending_notifications():
+    rows = await db_fetch("SELECT id, user_id, notify_at, text FROM pending_notifications")
+    _notify_queue.extend((r["notify_at"], r["id"], r["user_id"], r["text"]) for r in rows)
+    heapq.heapify(_notify_queue)
+
+async def notify_loop():
+    while True:
+        _notify_wakeup.clear()
+        if not _notify_queue:
+            await _notify_wakeup.wait()
+            continue
+
+        # спимо до найближчого повідомлення, але прокидаємось, якщо додали раніше
+        delay = (_notify_queue[0][0] - datetime.now()).total_seconds()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(_notify_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # забираємо всі повідомлення, час яких настав
+        now = datetime.now()
+        due = []
+        while _notify_queue and _notify_queue[0][0] <= now:
+            due.append(heapq.heappop(_notify_queue))
+
+        try:
+            # видаляємо записи з БД перед відправкою — те, що вже забрав інший процес, пропускаємо
+            claimed = await db_fetch(
+                "DELETE FROM pending_notifications WHERE id = ANY($1::int[]) RETURNING id",
+                [notification_id for _, notification_id, _, _ in due]
+            )
+        except Exception as e:
+            print(f"Помилка черги повідомлень: {e}")
+            # повертаємо повідомлення в чергу і пробуємо знову трохи згодом
+            for item in due:
+                heapq.heappush(_notify_queue, item)
+            await asyncio.sleep(NOTIFY_RETRY_DELAY)
+            continue
+        claimed_ids = {r["id"] for r in claimed}
+
+        # кілька повідомлень одному користувачу надсилаємо одним
+        by_user: dict[int, list[str]] = {}
+        for _, notification_id, user_id, text in due:
+            if notification_id in claimed_ids:
+                by_user.setdefault(user_id, []).append(text)
+        await asyncio.gather(*(
+            send_notify(user_id, message_text)
+            for user_id, texts in by_user.items()
+            for message_text in join_messages(texts)
+        ))
+
+
 async def get_available_hours(program_id: int, booking_date: datetime.date):
-    # 1) Тривалість програми
-    dur_row = await db_fetchrow("SELECT duration FROM programs WHERE id=$1", program_id)
-    if not dur_row:
+    # Тривалість програми
+    program = (await get_programs_map()).get(program_id)
+    if not program:
         return []
-    duration = int(dur_row["duration"] or 0)
+    duration = int(program[2] or 0)
 
-    # 2) Робочі години
+    # Робочі години
     WORK_START_HOUR = 9
     WORK_END_HOUR = 21  # кінець робочого дня (початок слота < 19:00)
     day_start = datetime.combine(booking_date, datetime.min.time())
     work_start = day_start + timedelta(hours=WORK_START_HOUR)
     work_end = day_start + timedelta(hours=WORK_END_HOUR)
 
-    # 3) Мінімально допустимий старт (щоб не пропонувати минуле)
+    # Мінімально допустимий старт (щоб не пропонувати минуле)
     now = datetime.now()
     min_allowed_start = work_start
     if booking_date == now.date():
         min_allowed_start = max(work_start, now + timedelta(minutes=BUFFER_MINUTES))
 
-    # 4) Кандидати (починаємо кожну годину, як і було)
-    candidate_starts = [
-        day_start + timedelta(hours=h)
-        for h in range(WORK_START_HOUR, WORK_END_HOUR)  # 9:00..18:00 включно
-    ]
-
-    # 5) Бронювання цього дня (для перевірки перетинів)
-    booked = await db_fetch(
-        """
-        SELECT b.booking_datetime AS bdt, p.duration AS pdur, b.status, b.actual_start, b.actual_end
-        FROM bookings b
-        LEFT JOIN programs p ON p.id = b.program_id
-        WHERE b.booking_datetime::date = $1
-        """,
-        booking_date,
+    # Кандидати (кожна година 9:00..20:00) і перевірка перетинів рахуються одним запитом:
+    # слот вільний, якщо жодне бронювання цього дня (з урахуванням статусу і буфера)
+    # його не перекриває
+    rows = await db_fetch(
+        AVAILABLE_HOURS_SQL,
+        duration,
+        work_start,
+        work_end,
+        min_allowed_start,
+        day_start,
+        timedelta(minutes=BUFFER_MINUTES),
     )
+    return [r["slot"] for r in rows]
 
-    available = []
-    for start in candidate_starts:
-        # пропускаємо те, що раніше за мінімально допустимий старт
-        if start < min_allowed_start:
-            continue
-
-        end = start + timedelta(minutes=duration)
 
-        # не дозволяємо слоти, які закінчуються після кінця робочого дня
-        if end > work_end:
-            continue
 
-        # перевірка перетинів з урахуванням статусів і буфера
-        conflict = False
-        for rec in booked:
-            if rec["status"] in ("in_progress", "finished"):
-                b_start = rec["actual_start"] or rec["bdt"]
-                b_end = rec["actual_end"] or (b_start + timedelta(minutes=int(rec["pdur"] or 0)))
-            else:
-                b_start = rec["bdt"]
-                b_end = b_start + timedelta(minutes=int(rec["pdur"] or 0))
+# Клавіатура з датами змінюється лише раз на добу — будуємо її один раз і тримаємо до півночі
+_date_kb_cache: tuple[date, int, ReplyKeyboardMarkup] | None = None
 
-            # буфер навколо зайнятого інтервалу
-            b_start -= timedelta(minutes=BUFFER_MINUTES)
-            b_end += timedelta(minutes=BUFFER_MINUTES)
-
-            if not (end <= b_start or start >= b_end):
-                conflict = True
-                break
-
-        if not conflict:
-            available.append(start.strftime("%H:%M"))
+def generate_date_buttons(days_ahead=7):
+    global _date_kb_cache
+    today = datetime.today().date()
+    if _date_kb_cache and _date_kb_cache[:2] == (today, days_ahead):
+        return _date_kb_cache[2]
 
-    return available
+    buttons = [[KeyboardButton(text=(today + timedelta(days=i)).strftime("%d.%m.%Y"))] for i in range(days_ahead)]
+    keyboard = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    _date_kb_cache = (today, days_ahead, keyboard)
+    return keyboard
 
+# Клавіатура програм: перебудовуємо лише коли змінився сам кеш програм (get_programs_map
+# повертає той самий dict, доки кеш не скинуто)
+_programs_kb_cache: tuple[dict, ReplyKeyboardMarkup] | None = None
 
+def generate_program_buttons(programs: dict[int, tuple]) -> ReplyKeyboardMarkup:
+    global _programs_kb_cache
+    if _programs_kb_cache and _programs_kb_cache[0] is programs:
+        return _programs_kb_cache[1]
 
-def generate_date_buttons(days_ahead=7):
-    today = datetime.today().date()
-    buttons = [[KeyboardButton(text=(today + timedelta(days=i)).strftime("%d.%m.%Y"))] for i in range(days_ahead)]
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    buttons = [[KeyboardButton(text=f"{p[0]} - {p[1]}")] for p in programs.values()]
+    keyboard = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    _programs_kb_cache = (programs, keyboard)
+    return keyboard
 
 # --- Головне меню ---
 main_menu = ReplyKeyboardMarkup(
@@ -260,22 +611,12 @@ main_menu = ReplyKeyboardMarkup(
     ],
     resize_keyboard=True
 )
-@router.message(lambda m: m.text == "ℹ️ Допомога")
-async def btn_help(message: types.Message):
-    await help_command(message)
-
-@router.message(lambda m: m.text == "🧾 Програми")
-async def btn_programs(message: types.Message):
-    await show_programs(message)
-
-@router.message(lambda m: m.text == "📝 Записати авто")
-async def btn_book(message: types.Message):
-    await book_program(message)
-
-@router.message(lambda m: m.text == "📋 Мої записи")
-async def btn_my_bookings(message: types.Message):
-    await my_bookings(message)
 
+# --- Кнопка "Поділитися номером" (однакова на кожному кроці з телефоном) ---
+SHARE_PHONE_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="📞 Поділитися номером", request_contact=True)]],
+    resize_keyboard=True
+)
 
 # ---------- КОМАНДИ ----------
 @router.message(Command("start"))
@@ -313,24 +654,51 @@ async def help_command(message: types.Message):
             "/add_admin <user_id>\n"
             "/del_admin <user_id>\n"
             "/admins - список адмінів\n"
+            "/users [сторінка] - список користувачів\n"
+            "/pool_stats - стан пулу з'єднань БД\n"
         )
     await message.answer(base_text + admin_text)
 
+USERS_PAGE_SIZE = 50
+PG_BIGINT_MAX = 2**63 - 1  # максимум int8 у Postgres
+
 @router.message(Command("users"))
 async def list_users(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("❌ Немає прав")
         return
 
-    rows = await db_fetch("SELECT user_id, username, phone_number, first_name, last_name, registered_at FROM users ORDER BY registered_at DESC")
+    # /users [сторінка] — по USERS_PAGE_SIZE на сторінку, щоб не було занадто довгого тексту
+    parts = message.text.split()
+    page = int(parts[1]) if len(parts) > 1 and parts[1].isdecimal() and int(parts[1]) > 0 else 1
+    offset = (page - 1) * USERS_PAGE_SIZE
+
+    rows = []
+    # більший OFFSET Postgres не прийме, а такої сторінки однаково не існує
+    if offset <= PG_BIGINT_MAX:
+        async with acquire_conn(readonly=True):
+            rows = await db_fetch(
+                """
+                SELECT user_id, username, phone_number, first_name, last_name, registered_at,
+                       COUNT(*) OVER () AS total
+                FROM users
+                ORDER BY registered_at DESC
+                LIMIT $1 OFFSET $2
+                """,
+                USERS_PAGE_SIZE, offset
+            )
 
     if not rows:
-        await message.answer("📭 Немає зареєстрованих користувачів")
+        if page == 1:
+            await message.answer("📭 Немає зареєстрованих користувачів")
+        else:
+            await message.answer(f"📭 Сторінка {page} порожня")
         return
 
-    text = "📋 Користувачі:\n\n"
-    for r in rows[:50]:  # обмежимо вивід, щоб не було занадто довгого тексту
-        text += (
+    total = rows[0]["total"]
+    lines = [f"📋 Користувачі ({offset + 1}–{offset + len(rows)} з {total}):\n\n"]
+    for r in rows:
+        lines.append(
             f"🆔 {r['user_id']} | @{r['username'] or '—'}\n"
             f"👤 {r['first_name'] or ''} {r['last_name'] or ''}\n"
             f"📞 {r['phone_number'] or '—'}\n"
@@ -338,7 +706,9 @@ async def list_users(message: types.Message):
             f"-----------------------------\n"
         )
 
-    await message.answer(text)
+    # ціла сторінка не вміщується в одне повідомлення (ліміт 4096 символів) — ділимо
+    for text in join_messages(lines, sep=""):
+        await message.answer(text)
 @router.message(Command("programs"))
 async def show_programs(message: types.Message):
     programs = await get_programs()
@@ -346,7 +716,7 @@ async def show_programs(message: types.Message):
         await message.answer("Програми ще не додані.")
         return
 
-    text = "Програми мийки:\n\n"
+    lines = ["Програми мийки:\n\n"]
     for p in programs:
         program_id, name, duration, price, description = p
         hours = duration // 60
@@ -355,37 +725,38 @@ async def show_programs(message: types.Message):
             time_str = f"{hours} год {'{} хв'.format(minutes) if minutes > 0 else ''}"
         else:
             time_str = f"{minutes} хв"
-        text += (
+        lines.append(
             f"{program_id} - {name}\n"
             f"🕒 {time_str} | 💵 {price:.2f} грн\n"
             f"📄 {description}\n"
             f"-----------------------------\n"
         )
-    await message.answer(text)
+    await message.answer("".join(lines))
 
 @router.message(Command("my_bookings"))
 async def my_bookings(message: types.Message):
     user_id = message.from_user.id
 
-    rows = await db_fetch(
-        """
-        SELECT b.id, p.name AS program_name, b.car_number, b.booking_datetime, b.status
-        FROM bookings b
-        LEFT JOIN programs p ON p.id = b.program_id
-        WHERE b.user_id=$1 AND b.status IN ('scheduled', 'in_progress')
-        ORDER BY b.booking_datetime ASC
-        """,
-        user_id
-    )
+    async with acquire_conn(readonly=True):
+        rows = await db_fetch(
+            """
+            SELECT b.id, p.name AS program_name, b.car_number, b.booking_datetime, b.status
+            FROM bookings b
+            LEFT JOIN programs p ON p.id = b.program_id
+            WHERE b.user_id=$1 AND b.status IN ('scheduled', 'in_progress')
+            ORDER BY b.booking_datetime ASC
+            """,
+            user_id
+        )
 
     if not rows:
         await message.answer("📭 У вас немає активних записів.")
         return
 
-    text = "📋 Ваші активні записи:\n\n"
+    lines = ["📋 Ваші активні записи:\n\n"]
     for r in rows:
         booking_time = r["booking_datetime"].strftime("%d.%m.%Y %H:%M")
-        text += (
+        lines.append(
             f"🆔 ID: {r['id']}\n"
             f"🧾 Програма: {r['program_name']}\n"
             f"🚗 Авто: {r['car_number']}\n"
@@ -394,7 +765,7 @@ async def my_bookings(message: types.Message):
             f"-----------------------------\n"
         )
 
-    await message.answer(text)
+    await message.answer("".join(lines))
 
 
 @router.message(Command("start_wash"))
@@ -409,71 +780,77 @@ async def start_wash(message: types.Message):
         return
 
     booking_id = int(parts[1])
-    row = await db_fetchrow("SELECT status FROM bookings WHERE id=$1", booking_id)
-    if not row:
-        await message.answer("❌ Такого бронювання не існує")
-        return
 
-    status = row["status"]
-    if status == "in_progress":
-        await message.answer("⚠ Мийка вже почата")
-        return
-    elif status == "finished":
-        await message.answer("⚠ Мийка вже завершена")
-        return
-
-    # Починаємо мийку
-    await db_execute(
-        "UPDATE bookings SET status='in_progress', actual_start=NOW() WHERE id=$1",
+    # Починаємо мийку; статус перевіряє сам UPDATE, окремий SELECT — лише якщо нічого не оновилось
+    row = await db_fetchrow(
+        """
+        UPDATE bookings
+        SET status='in_progress', actual_start=NOW()
+        WHERE id=$1
+          AND status IS DISTINCT FROM 'in_progress'
+          AND status IS DISTINCT FROM 'finished'
+        RETURNING id
+        """,
         booking_id
     )
+    if not row:
+        row = await db_fetchrow(BOOKING_STATUS_SQL, booking_id)
+        if not row:
+            await message.answer("❌ Такого бронювання не існує")
+        elif row["status"] == "in_progress":
+            await message.answer("⚠ Мийка вже почата")
+        else:
+            await message.answer("⚠ Мийка вже завершена")
+        return
+
     await message.answer(f"✅ Мийка {booking_id} почалась!")
 
 @router.message(Command("finish_wash"))
 async def finish_wash(message: types.Message):
-    if not await is_admin(message.from_user.id):
-        await message.answer("❌ Немає прав")
-        return
-
     parts = message.text.split()
-    if len(parts) != 2 or not parts[1].isdigit():
-        await message.answer("⚠ Використання: /finish_wash <ID>")
-        return
-
-    booking_id = int(parts[1])
-    row = await db_fetchrow("SELECT status FROM bookings WHERE id=$1", booking_id)
-    if not row:
-        await message.answer("❌ Такого бронювання не існує")
-        return
-
-    status = row["status"]
-    if status == "finished":
-        await message.answer("⚠ Мийка вже завершена")
-        return
+    booking_id = int(parts[1]) if len(parts) == 2 and parts[1].isdigit() else None
+
+    # з'єднання тримаємо лише на час запитів — відповідь (і очікування ліміту відправки) вже після
+    finished = None
+    async with acquire_conn():
+        if not await is_admin(message.from_user.id):
+            reply = "❌ Немає прав"
+        elif booking_id is None:
+            reply = "⚠ Використання: /finish_wash <ID>"
+        else:
+            # Якщо мийка ще не стартувала, стартуємо автоматично
+            row = await db_fetchrow(
+                """
+                UPDATE bookings
+                SET status='finished',
+                    actual_start=COALESCE(actual_start, NOW()),
+                    actual_end=NOW()
+                WHERE id=$1 AND status IS DISTINCT FROM 'finished'
+                RETURNING booking_datetime
+                """,
+                booking_id
+            )
+            if row:
+                reply = f"✅ Мийка {booking_id} завершена!"
+                finished = row["booking_datetime"]
+            elif await db_fetchrow(BOOKING_STATUS_SQL, booking_id):
+                reply = "⚠ Мийка вже завершена"
+            else:
+                reply = "❌ Такого бронювання не існує"
 
-    # Якщо мийка ще не стартувала, стартуємо автоматично
-    await db_execute(
-        """
-        UPDATE bookings
-        SET status='finished',
-            actual_start=COALESCE(actual_start, NOW()),
-            actual_end=NOW()
-        WHERE id=$1
-        """,
-        booking_id
-    )
-    await message.answer(f"✅ Мийка {booking_id} завершена!")
+    await message.answer(reply)
 
-    # Повідомлення наступних у черзі після BUFFER
-    await notify_next_after_buffer(booking_id)
+    # Повідомлення наступних у черзі після BUFFER — вже після підтвердження адміну:
+    # мийка завершена в будь-якому разі, навіть якщо сповіщення не вдалося
+    if finished is not None:
+        try:
+            await notify_next_after_buffer(finished)
+        except Exception as e:
+            print(f"Помилка сповіщення наступного клієнта після мийки {booking_id}: {e}")
 
 
 @router.message(Command("show_statistic"))
 async def show_statistic(message: types.Message):
-    if not await is_admin(message.from_user.id):
-        await message.answer("❌ Немає прав")
-        return
-
     args = message.text.split()
     start_date = None
     end_date = None
@@ -485,45 +862,59 @@ async def show_statistic(message: types.Message):
             end_date = start_date
         elif len(args) == 2:
             # тільки початкова дата
-            start_date = datetime.strptime(args[1], "%d.%m.%Y").date()
+            start_date = parse_dmy(args[1])
             end_date = datetime.today().date()
         elif len(args) >= 3:
-            start_date = datetime.strptime(args[1], "%d.%m.%Y").date()
-            end_date = datetime.strptime(args[2], "%d.%m.%Y").date()
+            start_date = parse_dmy(args[1])
+            end_date = parse_dmy(args[2])
     except Exception:
+        start_date = None
+
+    # з'єднання тримаємо лише на час запитів — відповіді надсилаємо вже після
+    rows = None
+    async with acquire_conn(readonly=True):
+        allowed = await is_admin(message.from_user.id)
+        if allowed and start_date:
+            # розбивка по програмах і загальний підсумок одним запитом:
+            # рядок з is_total = 1 — це підсумок (GROUPING SETS ()), він іде першим
+            rows = await db_fetch(
+                """
+                SELECT p.name, GROUPING(p.name) AS is_total, COUNT(*) AS cnt, SUM(p.price) AS total
+                FROM bookings b
+                LEFT JOIN programs p ON p.id = b.program_id
+                WHERE b.booking_datetime >= $1::date AND b.booking_datetime < $2::date + 1
+                GROUP BY GROUPING SETS ((p.name), ())
+                ORDER BY is_total DESC, cnt DESC
+                """,
+                start_date, end_date
+            )
+
+    if not allowed:
+        await message.answer("❌ Немає прав")
+        return
+    if rows is None:
         await message.answer("⚠ Використання: /show_statistic <дата_початку> [дата_кінця]\nПриклад: /show_statistic 01.08.2025 25.08.2025")
         return
 
-    rows = await db_fetch(
-        """
-        SELECT p.name, COUNT(*) AS cnt, SUM(p.price) AS total
-        FROM bookings b
-        LEFT JOIN programs p ON p.id = b.program_id
-        WHERE b.booking_datetime::date BETWEEN $1 AND $2
-        GROUP BY p.name
-        ORDER BY cnt DESC
-        """,
-        start_date, end_date
-    )
-
-    total_count = sum(r["cnt"] for r in rows)
-    total_sum = sum(float(r["total"] or 0) for r in rows)
-
-    if not rows:
+    totals, rows = rows[0], rows[1:]
+    if not totals["cnt"]:
         await message.answer(f"📭 Немає бронювань з {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}")
         return
 
-    text = (
+    total_count = totals["cnt"]
+    total_sum = totals["total"] or 0.0
+
+    lines = [
         f"📊 Статистика з {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}\n\n"
         f"🔢 Всього записів: {total_count}\n"
         f"💵 Загальна сума: {total_sum:.2f} грн\n\n"
         f"Розбивка по програмах:\n"
-    )
+    ]
 
     for r in rows:
-        text += f"▫ {r['name']}: {r['cnt']} раз(ів), {float(r['total'] or 0):.2f} грн\n"
+        lines.append(f"▫ {r['name']}: {r['cnt']} раз(ів), {r['total'] or 0.0:.2f} грн\n")
 
-    await message.answer(text)
+    await message.answer("".join(lines))
 
 
 @router.message(Command("add_program"))
@@ -556,6 +947,7 @@ async def add_program(message: types.Message):
             "INSERT INTO programs (name, duration, price, description) VALUES ($1, $2, $3, $4)",
             name, duration_minutes, price, description
         )
+        await notify_programs_changed()
         await message.answer(f"✅ Додано '{name}' ({duration_minutes} хв, {price:.2f} грн)\n📄 {description}")
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Програма вже існує")
@@ -595,6 +987,7 @@ async def edit_program(message: types.Message):
             new_value_casted = new_value
 
         await db_execute(f"UPDATE programs SET {field}=$1 WHERE id=$2", new_value_casted, program_id)
+        await notify_programs_changed()
         await message.answer(f"✏ Програму {program_id} змінено: {field} = {new_value_casted}")
     except Exception as e:
         await message.answer(f"⚠ Помилка: {e}")
@@ -642,25 +1035,60 @@ async def del_admin(message: types.Message):
     await db_execute("DELETE FROM admins WHERE user_id=$1", target_id)
     await message.answer(f"🗑 {target_id} видалений з адмінів")
 
+# Кеш юзернеймів адмінів {user_id: (monotonic-час, "@username")} — вони майже не змінюються
+ADMIN_USERNAME_TTL = 300
+_admin_usernames: dict[int, tuple[float, str]] = {}
+
+async def get_admin_username(admin_id: int) -> str:
+    cached = _admin_usernames.get(admin_id)
+    if cached and time.monotonic() - cached[0] < ADMIN_USERNAME_TTL:
+        return cached[1]
+
+    try:
+        user = await bot.get_chat(admin_id)
+    except Exception:
+        # помилку не кешуємо — спробуємо ще раз наступного разу
+        return "Не вказано"
+    username = f"@{user.username}" if user.username else "Не вказано"
+    _admin_usernames[admin_id] = (time.monotonic(), username)
+    return username
+
 @router.message(Command("admins"))
 async def list_admins(message: types.Message):
     if not await is_admin(message.from_user.id):
         await message.answer("❌ Немає прав")
         return
 
-    rows = await db_fetch("SELECT user_id FROM admins ORDER BY user_id")
+    async with acquire_conn(readonly=True):
+        rows = await db_fetch("SELECT user_id FROM admins ORDER BY user_id")
     admins_ids = [MAIN_ADMIN_ID] + [r["user_id"] for r in rows]
 
-    text = "📋 Адміни:\n"
-    for admin_id in admins_ids:
-        try:
-            user = await bot.get_chat(admin_id)
-            username = f"@{user.username}" if user.username else "Не вказано"
-        except Exception:
-            username = "Не вказано"
-        text += f"{admin_id} | {username}\n"
+    # запитуємо Telegram про всіх адмінів паралельно, а не по черзі
+    usernames = await asyncio.gather(*(get_admin_username(admin_id) for admin_id in admins_ids))
+
+    lines = ["📋 Адміни:\n"]
+    for admin_id, username in zip(admins_ids, usernames):
+        lines.append(f"{admin_id} | {username}\n")
+
+    await message.answer("".join(lines))
+
+@router.message(Command("pool_stats"))
+async def pool_stats(message: types.Message):
+    if not await is_admin(message.from_user.id):
+        await message.answer("❌ Немає прав")
+        return
+
+    lines = ["🗄 Пули з'єднань:\n"]
+    for title, p in (("Запис", pool), ("Читання", pool_ro)):
+        lines.append(
+            f"{title}: {p.get_size()} (min {p.get_min_size()}, max {p.get_max_size()}), "
+            f"вільні: {p.get_idle_size()}\n"
+        )
+    if isinstance(storage, TTLMemoryStorage):
+        lines.append(f"\n📝 Незавершених бронювань у пам'яті: {len(storage.storage)}\n")
+    await message.answer("".join(lines))
 
-    await message.answer(text)
+SHOW_BOOKING_LIMIT = 100
 
 @router.message(Command("show_booking"))
 async def show_booking(message: types.Message):
@@ -679,9 +1107,9 @@ async def show_booking(message: types.Message):
 
         # Спробуємо розпізнати дату (dd.mm.yyyy)
         try:
-            date = datetime.strptime(arg, "%d.%m.%Y").date()
-            filter_clause = "AND b.booking_datetime::date = $1"
-            params.append(date)
+            filter_date = parse_dmy(arg)
+            filter_clause = "AND b.booking_datetime >= $1::date AND b.booking_datetime < $1::date + 1"
+            params.append(filter_date)
         except ValueError:
             # Якщо це число → вважаємо user_id
             if arg.isdigit():
@@ -704,22 +1132,24 @@ async def show_booking(message: types.Message):
         ORDER BY
             CASE WHEN b.status='in_progress' THEN 0 ELSE 1 END,
             b.booking_datetime ASC
+        LIMIT {SHOW_BOOKING_LIMIT}
     """
 
-    rows = await db_fetch(query, *params)
+    async with acquire_conn(readonly=True):
+        rows = await db_fetch(query, *params)
 
     if not rows:
         await message.answer("📭 Немає бронювань за цим фільтром")
         return
 
-    text = "📋 Бронювання:\n\n"
+    lines = ["📋 Бронювання:\n\n"]
     for r in rows:
         booking_time = r["booking_datetime"]
         status = r["status"]
         actual_start = r["actual_start"].strftime("%H:%M") if r["actual_start"] else "—"
         actual_end = r["actual_end"].strftime("%H:%M") if r["actual_end"] else "—"
 
-        text += (
+        lines.append(
             f"ID: {r['id']} | Статус: {status}\n"
             f"👤 UserID: {r['user_id']} | @{r['username']}\n"
             f"📞 {r['phone_number']}\n"
@@ -730,7 +1160,12 @@ async def show_booking(message: types.Message):
             f"--------------------------------------------\n"
         )
 
-    await message.answer(text)
+    if len(rows) == SHOW_BOOKING_LIMIT:
+        lines.append(f"ℹ️ Показано перші {SHOW_BOOKING_LIMIT}, уточніть фільтр\n")
+
+    # SHOW_BOOKING_LIMIT записів не вміщується в одне повідомлення (ліміт 4096 символів) — ділимо
+    for text in join_messages(lines, sep=""):
+        await message.answer(text)
 
 @router.message(Command("delete"))
 async def delete_booking(message: types.Message):
@@ -768,11 +1203,6 @@ async def cmd_edit(message: types.Message):
             return
 
         booking_id = int(parts[1])
-        booking = await db_fetchrow("SELECT * FROM bookings WHERE id=$1", booking_id)
-
-        if not booking:
-            await message.answer(f"❌ Замовлення #{booking_id} не знайдено.")
-            return
 
         new_date = None
         new_time = None
@@ -798,7 +1228,7 @@ async def cmd_edit(message: types.Message):
 
             # дата
             try:
-                parsed_date = datetime.strptime(part, "%d.%m.%Y").date()
+                parsed_date = parse_dmy(part)
                 new_date = parsed_date
                 i += 1
                 continue
@@ -808,7 +1238,7 @@ async def cmd_edit(message: types.Message):
             # час
             try:
                 time_str = part.replace(".", ":")  # підтримка 17.41 і 17:41
-                parsed_time = datetime.strptime(time_str, "%H:%M").time()
+                parsed_time = parse_hm(time_str)
                 new_time = parsed_time
                 i += 1
                 continue
@@ -818,47 +1248,48 @@ async def cmd_edit(message: types.Message):
             await message.answer(f"❌ Невідомий параметр: {part}")
             return
 
-        # --- оновлюємо дані ---
+        # --- оновлюємо дані одним запитом ---
+        # дату/час поєднуємо з поточним значенням прямо в UPDATE, без попереднього SELECT
         updates = []
         params = []
 
-        if new_date or new_time:
-            current_dt = booking["booking_datetime"]
-
-            if new_date and new_time:
-                updated_dt = datetime.combine(new_date, new_time)
-            elif new_date:
-                updated_dt = datetime.combine(new_date, current_dt.time())
-            elif new_time:
-                updated_dt = datetime.combine(current_dt.date(), new_time)
-            else:
-                updated_dt = current_dt
-
-            updates.append("booking_datetime=$1")
-            params.append(updated_dt)
+        if new_date and new_time:
+            params.append(datetime.combine(new_date, new_time))
+            updates.append(f"booking_datetime=${len(params)}")
+        elif new_date:
+            params.append(new_date)
+            updates.append(f"booking_datetime=${len(params)}::date + booking_datetime::time")
+        elif new_time:
+            params.append(new_time)
+            updates.append(f"booking_datetime=booking_datetime::date + ${len(params)}::time")
 
         if new_status:
-            updates.append(f"status=${len(params)+1}")
             params.append(new_status)
+            updates.append(f"status=${len(params)}")
 
         if not updates:
             await message.answer("ℹ️ Нічого не змінено. Додайте дату, час або статус.")
             return
 
-        query = f"UPDATE bookings SET {', '.join(updates)} WHERE id=${len(params)+1}"
         params.append(booking_id)
+        query = (
+            f"UPDATE bookings SET {', '.join(updates)} WHERE id=${len(params)} "
+            f"RETURNING user_id, booking_datetime, status"
+        )
+        booking = await db_fetchrow(query, *params)
 
-        await db_execute(query, *params)
+        if not booking:
+            await message.answer(f"❌ Замовлення #{booking_id} не знайдено.")
+            return
+        updated_dt = booking["booking_datetime"]
 
         # повідомлення користувачу
-        booking = await db_fetchrow("SELECT user_id FROM bookings WHERE id=$1", booking_id)
-        if booking:
-            text_notify = f"🔔 Ваше замовлення #{booking_id} було змінено."
-            if new_date or new_time:
-                text_notify += f"\n📅 Нова дата/час: {updated_dt.strftime('%d.%m.%Y %H:%M')}"
-            if new_status:
-                text_notify += f"\n📌 Новий статус: {new_status}"
-            await send_notify(booking["user_id"], text_notify)
+        text_notify = f"🔔 Ваше замовлення #{booking_id} було змінено."
+        if new_date or new_time:
+            text_notify += f"\n📅 Нова дата/час: {updated_dt.strftime('%d.%m.%Y %H:%M')}"
+        if new_status:
+            text_notify += f"\n📌 Новий статус: {new_status}"
+        await send_notify(booking["user_id"], text_notify)
 
         # відповідь адміна
         text_admin = f"✅ Замовлення #{booking_id} змінено."
@@ -874,126 +1305,133 @@ async def cmd_edit(message: types.Message):
 
 # ---------- БРОНЮВАННЯ ДЛЯ КОРИСТУВАЧІВ ----------
 @router.message(Command("book"))
-async def book_program(message: types.Message):
-    programs = await get_programs()
+@router.message(F.text == "📝 Записати авто")
+async def book_program(message: types.Message, state: FSMContext):
+    programs = await get_programs_map()
     if not programs:
         await message.answer("Програми ще не додані.")
         return
-    buttons = [[KeyboardButton(text=f"{p[0]} - {p[1]}")] for p in programs]
-    keyboard = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
-    await message.answer("Оберіть програму:", reply_markup=keyboard)
-    user_booking[message.from_user.id] = {}
+    await message.answer("Оберіть програму:", reply_markup=generate_program_buttons(programs))
+    await state.set_state(BookingForm.program)
+    await state.set_data({})
+
+# --- Кнопки головного меню ---
+# Один фільтр F.text.in_ на всі кнопки і словник замість окремого lambda-фільтра на кожну
+# ("📝 Записати авто" зареєстрована прямо на book_program, бо тій потрібен FSMContext)
+MENU_BUTTONS = {
+    "ℹ️ Допомога": help_command,
+    "🧾 Програми": show_programs,
+    "📋 Мої записи": my_bookings,
+}
+
+@router.message(F.text.in_(MENU_BUTTONS.keys()))
+async def menu_button(message: types.Message):
+    await MENU_BUTTONS[message.text](message)
+
+# 1) Програма
+@router.message(BookingForm.program, F.text)
+async def process_program(message: types.Message, state: FSMContext):
+    try:
+        program_id = int(message.text.split(" - ")[0])
+    except Exception:
+        await message.answer("Оберіть програму кнопкою.")
+        return
+    await state.update_data(program_id=program_id)
+    await state.set_state(BookingForm.date)
+    await message.answer("Оберіть дату:", reply_markup=generate_date_buttons())
 
-@router.message()
-async def process_booking(message: types.Message):
-    user_id = message.from_user.id
-    if user_id not in user_booking:
+# 2) Дата
+@router.message(BookingForm.date, F.text)
+async def process_date(message: types.Message, state: FSMContext):
+    try:
+        booking_date = parse_dmy(message.text)
+        if booking_date < datetime.today().date():
+            raise ValueError
+    except Exception:
+        await message.answer("❌ Невірна дата")
         return
-    data = user_booking[user_id]
 
+    data = await state.get_data()
+    hours = await get_available_hours(data["program_id"], booking_date)
+    if not hours:
+        await message.answer("❌ Немає вільних годин, оберіть іншу дату", reply_markup=generate_date_buttons())
+        return
 
-    # 1) Програма
-    if "program_id" not in data:
-        try:
-            data["program_id"] = int(message.text.split(" - ")[0])
-        except Exception:
-            await message.answer("Оберіть програму кнопкою.")
-            return
-        await message.answer("Оберіть дату:", reply_markup=generate_date_buttons())
+    # запам'ятовуємо вільні години, щоб на кроці 3 не ходити в БД повторно;
+    # дані чернетки мають бути JSON-сумісні (RedisStorage), тому дату тримаємо як ISO-рядок
+    await state.update_data(booking_date=booking_date.isoformat(), _available_hours=hours)
+    await state.set_state(BookingForm.time)
+    buttons = [[KeyboardButton(text=h)] for h in hours]
+    await message.answer("Оберіть годину:", reply_markup=ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True))
+
+# 3) Час
+@router.message(BookingForm.time, F.text)
+async def process_time(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    hours = data.get("_available_hours") or await get_available_hours(
+        data["program_id"], date.fromisoformat(data["booking_date"])
+    )
+    if message.text not in hours:
+        await message.answer("❌ Ця година вже зайнята")
+        return
+    # час уже перевірений — одразу збираємо повну дату-час бронювання, щоб на кроці 5
+    # не розбирати рядки повторно (ISO-рядок, бо дані чернетки мають бути JSON-сумісні)
+    booking_dt = datetime.combine(date.fromisoformat(data["booking_date"]), parse_hm(message.text))
+    await state.update_data(booking_time=message.text, booking_dt=booking_dt.isoformat())
+    await state.set_state(BookingForm.car)
+    await message.answer("Введіть номер авто:", reply_markup=ReplyKeyboardRemove())
+
+# 4) Авто
+@router.message(BookingForm.car, F.text)
+async def process_car(message: types.Message, state: FSMContext):
+    car_number = message.text.upper()
+    if not CAR_NUMBER_RE.match(car_number):
+        await message.answer("❌ Невірний формат номера. Приклад: AA1234BB")
         return
+    await state.update_data(car_number=car_number)
+    await state.set_state(BookingForm.phone)
+    await message.answer("Надішліть свій номер телефону:", reply_markup=SHARE_PHONE_KB)
 
-    # 2) Дата
-    if "booking_date" not in data:
-        try:
-            date = datetime.strptime(message.text, "%d.%m.%Y").date()
-            if date < datetime.today().date():
-                raise ValueError
-            data["booking_date"] = date
-        except Exception:
-            await message.answer("❌ Невірна дата")
-            return
+# 5) Телефон
+@router.message(BookingForm.phone, F.contact | F.text)
+async def process_phone(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    phone_number = None
+
+    # Якщо користувач поділився контактом
+    if message.contact and message.contact.phone_number:
+        phone_number = message.contact.phone_number
 
-        hours = await get_available_hours(data["program_id"], data["booking_date"])
-        if not hours:
-            await message.answer("❌ Немає вільних годин, оберіть іншу дату", reply_markup=generate_date_buttons())
-            data.pop("booking_date")
+    # Якщо користувач ввів вручну
+    # (050 123 45 67, 0501234567, +380501234567 ... -> +380501234567)
+    elif message.text:
+        try:
+            parsed = phonenumbers.parse(message.text, "UA")
+        except phonenumbers.NumberParseException:
+            parsed = None
+        if parsed is None or not phonenumbers.is_valid_number(parsed):
+            await message.answer("❌ Невірний формат номера. Введіть ще раз або скористайтесь кнопкою.", reply_markup=SHARE_PHONE_KB)
             return
+        phone_number = phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
 
-        buttons = [[KeyboardButton(text=h)] for h in hours]
-        await message.answer("Оберіть годину:", reply_markup=ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True))
-        return
 
-    # 3) Час
-    if "booking_time" not in data:
-        hours = await get_available_hours(data["program_id"], data["booking_date"])
-        if message.text not in hours:
-            await message.answer("❌ Ця година вже зайнята")
-            return
-        data["booking_time"] = message.text
-        await message.answer("Введіть номер авто:", reply_markup=ReplyKeyboardRemove())
+    if not phone_number:
+        await message.answer("Будь ласка, надішліть свій номер телефону (через кнопку або вручну):", reply_markup=SHARE_PHONE_KB)
         return
 
-    # 4) Авто
-    if "car_number" not in data:
-        if not re.match(r"^[A-ZА-ЯІЇЄ]{2}\d{4}[A-ZА-ЯІЇЄ]{2}$", message.text.upper()):
-            await message.answer("❌ Невірний формат номера. Приклад: AA1234BB")
-            return
-        data["car_number"] = message.text.upper()
-        kb = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="📞 Поділитися номером", request_contact=True)]],
-            resize_keyboard=True
-        )
-        await message.answer("Надішліть свій номер телефону:", reply_markup=kb)
-        return
+    # 🔹 Оновлюємо дані
+    data = await state.get_data()
+    data["phone_number"] = phone_number
 
-    # 5) Телефон
-    if "phone_number" not in data:
-        phone_number = None
-
-        # Якщо користувач поділився контактом
-        if message.contact and message.contact.phone_number:
-            phone_number = message.contact.phone_number
-
-        # Якщо користувач ввів вручну
-        elif message.text:
-            digits = "".join([c for c in message.text if c.isdigit()])
-            if len(digits) >= 9:  # мінімальна довжина
-                if not message.text.startswith("+"):
-                    phone_number = "+" + digits
-                else:
-                    phone_number = message.text
-            else:
-                kb = ReplyKeyboardMarkup(
-                    keyboard=[[KeyboardButton(text="📞 Поділитися номером", request_contact=True)]],
-                    resize_keyboard=True
-                )
-                await message.answer("❌ Невірний формат номера. Введіть ще раз або скористайтесь кнопкою.", reply_markup=kb)
-                return
-
-
-        if not phone_number:
-            kb = ReplyKeyboardMarkup(
-                keyboard=[[KeyboardButton(text="📞 Поділитися номером", request_contact=True)]],
-                resize_keyboard=True
-            )
-            await message.answer("Будь ласка, надішліть свій номер телефону (через кнопку або вручну):", reply_markup=kb)
-            return
+    booking_dt = datetime.fromisoformat(data["booking_dt"])
+    username = message.from_user.username or "Не вказано"
 
-        # 🔹 Оновлюємо дані
-        data["phone_number"] = phone_number
+    # користувач і бронювання — на одному з'єднанні в одній транзакції:
+    # або з'являються обидва записи, або жоден
+    async with acquire_conn() as conn, conn.transaction():
         await save_user(message.from_user, phone_number)
-
-        booking_dt = datetime.combine(
-            data["booking_date"],
-            datetime.strptime(data["booking_time"], "%H:%M").time()
-        )
-        username = message.from_user.username or "Не вказано"
-
         await db_execute(
-            """
-            INSERT INTO bookings (user_id, username, phone_number, program_id, car_number, booking_datetime)
-            VALUES ($1, $2, $3, $4, $5, $6)
-            """,
+            BOOKINGS_INSERT_SQL,
             user_id,
             username,
             data["phone_number"],
@@ -1002,26 +1440,93 @@ async def process_booking(message: types.Message):
             booking_dt,
         )
 
-        await message.answer(
-            f"✅ Запис підтверджено:\n"
-            f"📅 {data['booking_date']} ⏰ {data['booking_time']}\n"
-            f"🚗 {data['car_number']}\n"
-            f"📞 {data['phone_number']}",
-            reply_markup=main_menu
-        )
-        user_booking.pop(user_id, None)
-        return
+    await message.answer(
+        f"✅ Запис підтверджено:\n"
+        f"📅 {data['booking_date']} ⏰ {data['booking_time']}\n"
+        f"🚗 {data['car_number']}\n"
+        f"📞 {data['phone_number']}",
+        reply_markup=main_menu
+    )
+    await state.clear()
+
+# Фото, стікери тощо посеред бронювання — кроки вище їх не приймають (фільтри F.text / F.contact)
+@router.message(StateFilter(BookingForm))
+async def process_booking_non_text(message: types.Message):
+    await message.answer("Будь ласка, надішліть відповідь текстом або скористайтесь кнопками.")
 
 
 
 # ---------- СТАРТ ----------
+async def init_connection(conn: asyncpg.Connection):
+    # NUMERIC (ціни, суми) одразу як float — без проміжних Decimal на кожен рядок
+    await conn.set_type_codec("numeric", encoder=str, decoder=float, schema="pg_catalog", format="text")
+
+async def create_pool(dsn: str, *, min_size: int, max_size: int, readonly: bool = False) -> asyncpg.Pool:
+    server_settings = {"jit": "off"}  # короткі OLTP-запити — JIT лише додає затримку
+    if readonly:
+        server_settings["default_transaction_read_only"] = "on"
+    # asyncpg відкриває min_size з'єднань паралельно ще в create_pool, тож перші запити
+    # користувачів не чекають на встановлення з'єднання
+    return await asyncpg.create_pool(
+        dsn,
+        min_size=min_size,
+        max_size=max_size,
+        max_queries=DB_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,  # закриваємо простої до того, як їх вб'є сервер/pgbouncer
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,  # кеш prepared statements на кожному з'єднанні
+        server_settings=server_settings,
+        init=init_connection,
+    )
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=WEBHOOK_PORT).start()
+    try:
+        # реєструємо webhook лише коли сервер уже слухає порт — інакше перші оновлення загубляться
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        await asyncio.Event().wait()  # працюємо, доки процес не зупинять
+    finally:
+        await runner.cleanup()
+
 async def main():
-    global pool
+    global pool, pool_ro
     # SSL для Supabase зазвичай не потрібен явно в URI, але якщо у вас вимагає — додайте ?sslmode=require
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    pool = await create_pool(DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+    pool_ro = await create_pool(
+        DATABASE_URL_REPLICA or DATABASE_URL,
+        min_size=DB_POOL_RO_MIN_SIZE,
+        max_size=DB_POOL_RO_MAX_SIZE,
+        readonly=True,
+    )
     await init_db()
+
+    # окреме з'єднання поза пулом — слухаємо зміни програм від інших процесів бота
+    listen_conn = await asyncpg.connect(DATABASE_URL)
+    await listen_conn.add_listener("programs_changed", invalidate_programs_cache)
+
+    # фоновий цикл відкладених повідомлень (з тим, що залишилось з попереднього запуску)
+    await load_pending_notifications()
+    notify_task = asyncio.create_task(notify_loop())
+
     dp.include_router(router)
-    await dp.start_polling(bot)
+    if WEBHOOK_URL:
+        await run_webhook()
+    else:
+        await bot.delete_webhook()  # інакше getUpdates не працює, якщо раніше був webhook
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())